@@ -1,61 +1,82 @@
 
 import glob
+import json
+import os
+import shutil
 import subprocess
+import numpy as np
+import pandas as pd
 import pendulum
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from zipfile import ZipFile
-from os.path import exists, curdir, join, abspath, splitext, basename, dirname
+from os.path import (
+    exists,
+    curdir,
+    join,
+    abspath,
+    dirname,
+    getsize,
+    getmtime,
+    isabs,
+    realpath,
+    splitdrive,
+)
 from typing import List
 
-RUN_TIMESTAMP = pendulum.today().format("YYYY-MM-DD")
-APP_DIRECTORY = curdir | p(abspath) | p(join, "data")
-
-
-indicators = (
-    "Air transport, passengers carried",
-    "Cause of death, by communicable diseases and maternal, prenatal and nutrition conditions (% of total)",
-    "Cause of death, by non-communicable diseases (% of total)",
-    "Current health expenditure per capita, PPP (current international $)",
-    "Death rate, crude (per 1,000 people)",
-    "Diabetes prevalence (% of population ages 20 to 79)",
-    "GDP per capita, PPP (current international $)",
-    "Hospital beds (per 1,000 people)",
-    "Incidence of tuberculosis (per 100,000 people)",
-    "International migrant stock, total",
-    "International tourism, number of arrivals",
-    "International tourism, number of departures",
-    "Labor force participation rate, total (% of total population ages 15+) (modeled ILO estimate)",
-    "Life expectancy at birth, total (years)",
-    "Mortality from CVD, cancer, diabetes or CRD between exact ages 30 and 70 (%)",
-    "Mortality rate attributed to household and ambient air pollution, age-standardized (per 100,000 population)",
-    "Mortality rate attributed to unsafe water, unsafe sanitation and lack of hygiene (per 100,000 population)",
-    "Mortality rate, adult, female (per 1,000 female adults)",
-    "Mortality rate, adult, male (per 1,000 male adults)",
-    "Number of people spending more than 10% of household consumption or income on out-of-pocket health care expenditure",
-    "Number of people spending more than 25% of household consumption or income on out-of-pocket health care expenditure",
-    "Nurses and midwives (per 1,000 people)",
-    "Out-of-pocket expenditure (% of current health expenditure)",
-    "PM2.5 air pollution, population exposed to levels exceeding WHO guideline value (% of total)",
-    "People using at least basic sanitation services (% of population)",
-    "People using safely managed sanitation services (% of population)",
-    "People with basic handwashing facilities including soap and water (% of population)",
-    "Physicians (per 1,000 people)",
-    "Population ages 15-64 (% of total)",
-    "Population ages 65 and above (% of total)",
-    "Population density (people per sq. km of land area)",
-    "Population in the largest city (% of urban population)",
-    "Population in urban agglomerations of more than 1 million (% of total population)",
-    "Population, total",
-    "Poverty headcount ratio at $3.20 a day (2011 PPP) (% of population)",
-    "Prevalence of HIV, total (% of population ages 15-49)",
-    "Smoking prevalence, females (% of adults)",
-    "Smoking prevalence, males (% of adults)",
-    "Survival to age 65, female (% of cohort)",
-    "Survival to age 65, male (% of cohort)",
-    "Trade (% of GDP)",
-    "Tuberculosis case detection rate (%, all forms)",
-    "Tuberculosis treatment success rate (% of new cases)",
-    "Urban population (% of total)",
+MANIFEST_FILENAME = ".manifest.json"
+COPY_BUFFER_SIZE = 1 << 20  # 1 MiB
+CSV_CHUNK_SIZE = 100_000  # rows
+
+
+INDICATORS = frozenset(
+    {
+        "Air transport, passengers carried",
+        "Cause of death, by communicable diseases and maternal, prenatal and nutrition conditions (% of total)",
+        "Cause of death, by non-communicable diseases (% of total)",
+        "Current health expenditure per capita, PPP (current international $)",
+        "Death rate, crude (per 1,000 people)",
+        "Diabetes prevalence (% of population ages 20 to 79)",
+        "GDP per capita, PPP (current international $)",
+        "Hospital beds (per 1,000 people)",
+        "Incidence of tuberculosis (per 100,000 people)",
+        "International migrant stock, total",
+        "International tourism, number of arrivals",
+        "International tourism, number of departures",
+        "Labor force participation rate, total (% of total population ages 15+) (modeled ILO estimate)",
+        "Life expectancy at birth, total (years)",
+        "Mortality from CVD, cancer, diabetes or CRD between exact ages 30 and 70 (%)",
+        "Mortality rate attributed to household and ambient air pollution, age-standardized (per 100,000 population)",
+        "Mortality rate attributed to unsafe water, unsafe sanitation and lack of hygiene (per 100,000 population)",
+        "Mortality rate, adult, female (per 1,000 female adults)",
+        "Mortality rate, adult, male (per 1,000 male adults)",
+        "Number of people spending more than 10% of household consumption or income on out-of-pocket health care expenditure",
+        "Number of people spending more than 25% of household consumption or income on out-of-pocket health care expenditure",
+        "Nurses and midwives (per 1,000 people)",
+        "Out-of-pocket expenditure (% of current health expenditure)",
+        "PM2.5 air pollution, population exposed to levels exceeding WHO guideline value (% of total)",
+        "People using at least basic sanitation services (% of population)",
+        "People using safely managed sanitation services (% of population)",
+        "People with basic handwashing facilities including soap and water (% of population)",
+        "Physicians (per 1,000 people)",
+        "Population ages 15-64 (% of total)",
+        "Population ages 65 and above (% of total)",
+        "Population density (people per sq. km of land area)",
+        "Population in the largest city (% of urban population)",
+        "Population in urban agglomerations of more than 1 million (% of total population)",
+        "Population, total",
+        "Poverty headcount ratio at $3.20 a day (2011 PPP) (% of population)",
+        "Prevalence of HIV, total (% of population ages 15-49)",
+        "Smoking prevalence, females (% of adults)",
+        "Smoking prevalence, males (% of adults)",
+        "Survival to age 65, female (% of cohort)",
+        "Survival to age 65, male (% of cohort)",
+        "Trade (% of GDP)",
+        "Tuberculosis case detection rate (%, all forms)",
+        "Tuberculosis treatment success rate (% of new cases)",
+        "Urban population (% of total)",
+    }
 )
 
 
@@ -83,9 +104,28 @@ class KaggleData:
     def get_path(self):
         return join(self.destination_dir, self.source_filename.split("/")[-1])
 
+    def get_cache_key(self):
+        return "{}/{}".format(self.dataset, self.source_filename)
+
+    def is_cached(self, manifest):
+        path = self.get_path()
+        entry = manifest.get(self.get_cache_key(), {})
+
+        return (
+            exists(path)
+            and entry.get("path") == path
+            and entry.get("size") == getsize(path)
+        )
+
+
+def get_app_directory():
+    return abspath(join(curdir, "data"))
+
 
 def download_data():
-    directory = join(APP_DIRECTORY, RUN_TIMESTAMP)
+    app_directory = get_app_directory()
+    run_timestamp = pendulum.today().format("YYYY-MM-DD")
+    directory = join(app_directory, run_timestamp)
 
     if not exists(directory):
         os.makedirs(directory)
@@ -105,103 +145,213 @@ def download_data():
         ),
     ]
 
-    # Worldbank downloads a zip file...
-    unzip_files(directory)
+    manifest_path = join(app_directory, MANIFEST_FILENAME)
+    manifest = read_manifest(manifest_path)
+
+    stale = [d for d in datasets if not d.is_cached(manifest)]
 
-    for kaggle_source in datasets:
-        subprocess.run(kaggle_source.cli_download_command())
+    if stale:
+        with ThreadPoolExecutor(max_workers=len(stale)) as executor:
+            results = list(
+                executor.map(
+                    lambda kaggle_source: subprocess.run(
+                        kaggle_source.cli_download_command()
+                    ),
+                    stale,
+                )
+            )
+
+        # Worldbank downloads a zip file...
+        unzip_files(directory)
+
+        for kaggle_source, result in zip(stale, results):
+            path = kaggle_source.get_path()
+
+            # a failed download may leave a partial file behind
+            if result.returncode == 0 and exists(path):
+                manifest[kaggle_source.get_cache_key()] = {
+                    "path": path,
+                    "size": getsize(path),
+                    "mtime": getmtime(path),
+                }
+
+        write_manifest(manifest_path, manifest)
+
+        for result in results:
+            result.check_returncode()
 
     return {d.name: d.get_path() for d in datasets}
 
 
+def read_manifest(path):
+    if not exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    partial = path + ".tmp"
+
+    with open(partial, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    os.replace(partial, path)
+
+
 def unzip_files(source_dir):
     files = glob.glob(join(source_dir, "*.zip"))
-    for f in files:
-        filepath = os.path.splitext(f)[0]  # unzipped path
 
-        if not exists(filepath):
-            file = filepath | p(basename)
-            path = filepath | p(dirname)
+    if not files:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(8, len(files))) as executor:
+        list(executor.map(unzip_file, files))
+
+
+def unzip_file(f):
+    path = dirname(f)
+
+    with ZipFile(f) as z:
+        # validate every member name before anything is written
+        members = [
+            (info, get_member_destination(path, info.filename))
+            for info in z.infolist()
+            if not info.is_dir()
+        ]
+        wanted = [(info, dest) for info, dest in members if not exists(dest)]
+
+        # read the members in archive order for one sequential pass
+        for info, destination in sorted(wanted, key=lambda m: m[0].header_offset):
+            os.makedirs(dirname(destination), exist_ok=True)
+
+            # write beside the target so an interrupted copy is never taken
+            # for a complete, preallocated file on the next run
+            partial = destination + ".part"
+
+            with z.open(info) as src, open(partial, "wb") as dst:
+                preallocate(dst, info.file_size)
+                shutil.copyfileobj(src, dst, length=COPY_BUFFER_SIZE)
+
+            os.replace(partial, destination)
 
-            ZipFile(f).extract(member=file, path=path)
+
+def get_member_destination(path, name):
+    root = realpath(path)
+    destination = realpath(join(root, name))
+
+    # the same guarantee ZipFile.extract gives: never write outside `path`
+    if isabs(name) or splitdrive(name)[0] or not destination.startswith(root + os.sep):
+        raise ValueError("Archive member {} escapes {}".format(name, path))
+
+    return destination
+
+
+def preallocate(file, size):
+    # reserve the extents up front rather than growing the file per write
+    if size and hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(file.fileno(), 0, size)
 
 
 def format_columns(df):
-    return (
-        df.pipe(lambda df: df.rename(columns={c: c.split("/")[0] for c in df.columns}))
-        .pipe(
-            lambda df: df.rename(columns={c: c.replace(" ", "_") for c in df.columns})
+    names = format_column_names(tuple(df.columns))
+
+    # relabel a shallow copy so the row data is shared, not copied
+    df = df.copy(deep=False)
+    df.columns = [names[c] for c in df.columns]
+    return df
+
+
+@lru_cache(maxsize=32)
+def format_column_names(columns):
+    return {c: c.split("/")[0].replace(" ", "_").upper() for c in columns}
+
+
+def read_worldbank(path, years=20, indicators=INDICATORS):
+    header = pd.read_csv(path, nrows=0).columns
+    year_columns = sorted((c for c in header if c.isdigit()), key=int)[-years:]
+
+    with pd.read_csv(
+        path,
+        usecols=["Country Name", "Indicator Name"] + year_columns,
+        dtype={c: "float32" for c in year_columns},
+        chunksize=CSV_CHUNK_SIZE,
+    ) as chunks:
+        df = pd.concat(
+            chunk[chunk["Indicator Name"].isin(indicators)] for chunk in chunks
         )
-        .pipe(lambda df: df.rename(columns={c: c.upper() for c in df.columns}))
-    )
+
+    return df.pipe(format_columns)
 
 
-def clean_data(df, years=20):
+def clean_data(df):
     return (
-        df.drop(["INDICATOR_CODE", "COUNTRY_CODE", "UNNAMED:_63"], axis=1)
-        .pipe(lambda df: pd.concat([df.iloc[:, :2], df.iloc[:, -years:]], axis=1))
-        .pipe(lambda df: df.dropna(subset=df.columns[2:], axis=0, how="all"))
+        df.dropna(subset=df.columns[2:], axis=0, how="all")
         .replace({"United States": "US"})
+        .astype({"COUNTRY_NAME": "category", "INDICATOR_NAME": "category"})
     )
 
 
 def keep_relevant_countries(df, corona_df):
     return (
-        df.loc[df.COUNTRY_NAME.isin(corona_df.COUNTRY), :]
+        df.loc[df.COUNTRY_NAME.isin(corona_df.COUNTRY.unique()), :]
     )
 
 
 def reindex_by_country_indicator(df):
-    return df.melt(
-        id_vars=["COUNTRY_NAME", "INDICATOR_NAME"], var_name="YEAR", value_name="VALUE",
-    ).assign(YEAR=lambda df: df.YEAR.astype("datetime64[Y]"))
+    df = df.set_index(["COUNTRY_NAME", "INDICATOR_NAME"])
+    return df.set_axis(df.columns.astype("int16"), axis=1).sort_index(axis=1)
 
 
 def interpolate_values(df):
-    df["VALUE"] = df.groupby(["COUNTRY_NAME", "INDICATOR_NAME"]).VALUE.apply(
-        lambda s: s.interpolate(method="linear")
-    )
-    return df
+    return df.interpolate(method="linear", axis=1)
 
 
 def summarize(df):
-    def get_latest_value(series):
-        return series[series.notnull()].values[~0]
-
-    def calculate_growth_rate(series):
-        series = series.reset_index(drop=True)
-
-        idx = np.isfinite(series)
-
-        if not any(idx):
-            return np.nan
-
-        x = series.loc[idx].index
-        y = series.loc[idx]
-
-        n = x[~0]  # total number of periods
+    values = df.to_numpy()
+    valid = ~np.isnan(values)
+    rows = np.arange(len(values))
 
-        assert n > 0
+    # positions of the earliest and latest non-null value in each row
+    earliest = valid.argmax(axis=1)
+    latest = valid.shape[1] - 1 - valid[:, ::-1].argmax(axis=1)
 
-        y_0 = y.iloc[0]
-        y_n = y.iloc[~0]
+    # total number of periods, in years between the earliest and latest value
+    years = df.columns.to_numpy()
+    n = pd.Series(years[latest] - years[earliest], index=df.index)
 
-        growth_rate = (y_n / y_0) ** (1 / n) - 1
+    y_0 = pd.Series(values[rows, earliest], index=df.index)
+    y_n = pd.Series(values[rows, latest], index=df.index)
 
-        return growth_rate
+    growth_rate = ((y_n / y_0) ** (1 / n.astype("float32")) - 1).where(n > 0)
 
     return (
-        df.groupby(["COUNTRY_NAME", "INDICATOR_NAME"])
-        .agg(
-            CURRENT_YEAR=("YEAR", get_latest_value),
-            CURRENT_VALUE=("VALUE", get_latest_value),
-            AVERAGE_VALUE=("VALUE", "mean"),
-            GROWTH_RATE=("VALUE", calculate_growth_rate),
+        pd.DataFrame(
+            {
+                "CURRENT_YEAR": df.columns[latest],
+                "CURRENT_VALUE": y_n,
+                "AVERAGE_VALUE": df.mean(axis=1),
+                "GROWTH_RATE": growth_rate,
+            },
+            index=df.index,
         )
+        .loc[valid.any(axis=1)]
         .reset_index()
     )
 
 
+def process_worldbank(path, corona_df, years=20):
+    return (
+        read_worldbank(path, years=years)
+        .pipe(clean_data)
+        .pipe(keep_relevant_countries, corona_df)
+        .pipe(reindex_by_country_indicator)
+        .pipe(interpolate_values)
+        .pipe(summarize)
+    )
+
+
 def pivot_by_indicator(df):
     return df.pivot(
         index="COUNTRY_NAME",
@@ -211,4 +361,13 @@ def pivot_by_indicator(df):
 
 
 def fill_missing_indicators(df):
-    return df.fillna(df.mean())
+    values = df.to_numpy(copy=True)
+    missing = np.isnan(values)
+
+    with np.errstate(invalid="ignore"):
+        means = np.nansum(values, axis=0) / (~missing).sum(axis=0)
+
+    rows, columns = np.nonzero(missing)
+    values[rows, columns] = means[columns]
+
+    return pd.DataFrame(values, index=df.index, columns=df.columns)